@@ -1,10 +1,12 @@
 import requests
 import os
+import hmac
 from dotenv import load_dotenv
 
 load_dotenv()
 
 CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
 
 ALLOWED_EXTENSION_IDS = [
     "jdidlnlcanjlbabpcgkcdkpfigfemhjd"
@@ -65,4 +67,10 @@ def verify_google_token(token: str, extension_id: str = None):
         return None
     except Exception as e:
         print(f"DEBUG: Auth Exception: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def verify_admin_key(key: str) -> bool:
+    # Admin API is disabled unless ADMIN_API_KEY is configured
+    if not ADMIN_API_KEY or not key:
+        return False
+    return hmac.compare_digest(key.encode(), ADMIN_API_KEY.encode())
@@ -6,6 +6,13 @@ import time
 
 DB_NAME = "users.db"
 
+# Analytics exports are read in chunks of this many rows
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_TABLES = ('usage_daily', 'users', 'history')
+
+# History imports are written in transactions of this many rows
+HISTORY_IMPORT_BATCH_SIZE = 5000
+
 # Caching for performance
 PLAN_CACHE = {}
 
@@ -79,6 +86,18 @@ def get_db():
     finally:
         conn.close()
 
+@contextmanager
+def get_readonly_db():
+    """Read-only connection for analytics. WAL lets it read alongside production writers."""
+    # check_same_thread=False: streaming responses may resume the cursor from another worker thread
+    conn = sqlite3.connect(f"file:{DB_NAME}?mode=ro", uri=True, timeout=10.0, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only=ON")
+    try:
+        yield conn
+    finally:
+        conn.close()
+
 def init_db():
     global PLAN_CACHE
     with get_db() as conn:
@@ -167,6 +186,36 @@ def init_db():
             )
         ''')
 
+        # Daily usage rollup, maintained incrementally by record_usage()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS usage_daily (
+                day DATE NOT NULL,
+                plan_id TEXT NOT NULL,
+                mode TEXT NOT NULL,
+                requests INTEGER DEFAULT 0,
+                input_chars INTEGER DEFAULT 0,
+                output_chars INTEGER DEFAULT 0,
+                PRIMARY KEY (day, plan_id, mode)
+            )
+        ''')
+
+        # Indexes for history paging and analytics
+        c.execute('CREATE INDEX IF NOT EXISTS idx_history_user_time ON history (google_id, timestamp)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_users_subscription ON users (subscription_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_users_last_reset ON users (last_reset)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_users_subscription_expires ON users (subscription_expires)')
+
+        # Log of scheduled job runs
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS job_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job TEXT NOT NULL,
+                started_at DATETIME NOT NULL,
+                duration_ms REAL NOT NULL,
+                rows_affected INTEGER NOT NULL
+            )
+        ''')
+
     # Pre-warm plan cache
     all_plans = []
     with get_db() as conn:
@@ -186,6 +235,16 @@ def get_plan(plan_id: str):
     """Get a specific plan by ID from cache"""
     return PLAN_CACHE.get(plan_id)
 
+def get_plan_expiry(plan_id: str, plan: dict):
+    """Expiry date for a newly purchased plan, None if it never expires"""
+    if plan_id == 'go_pro_plus':
+        return (datetime.now() + timedelta(days=365)).date()
+    elif plan_id == 'go_pro_ultra':
+        return (datetime.now() + timedelta(days=36500)).date() # 100 years = forever
+    elif plan['price'] > 0:
+        return (datetime.now() + timedelta(days=30)).date()
+    return None
+
 def get_user_subscription(google_id: str, email: str = None) -> dict:
     """Get user's subscription info and settings. Syncs email and creates user if missing."""
     with get_db() as conn:
@@ -202,9 +261,9 @@ def get_user_subscription(google_id: str, email: str = None) -> dict:
         current_date = datetime.now().date()
         
         if row is None:
-            # New user
+            # New user; a concurrent first request may have created it already
             c.execute('''
-                INSERT INTO users (google_id, email, requests_used, last_reset, subscription_id) 
+                INSERT OR IGNORE INTO users (google_id, email, requests_used, last_reset, subscription_id) 
                 VALUES (?, ?, 0, ?, 'free')
             ''', (google_id, email, current_date))
             
@@ -231,30 +290,23 @@ def get_user_subscription(google_id: str, email: str = None) -> dict:
         if email and row['email'] != email:
             c.execute('UPDATE users SET email = ? WHERE google_id = ?', (email, google_id))
 
-        # Check subscription expiry
+        # Expirations and monthly resets are written by the scheduled jobs
+        # (expire_subscriptions / reset_monthly_usage); here we only report the effective
+        # state in case a job has not run yet. ISO date strings compare in date order.
+        today = current_date.isoformat()
         subscription_id = row['subscription_id'] or 'free'
         expires = row['subscription_expires']
         
-        if expires and subscription_id != 'free':
-            expire_date = datetime.strptime(expires, '%Y-%m-%d').date()
-            if current_date > expire_date:
-                subscription_id = 'free'
-                c.execute('''
-                    UPDATE users SET subscription_id = 'free', subscription_expires = NULL 
-                    WHERE google_id = ?
-                ''', (google_id,))
+        if expires and subscription_id != 'free' and expires < today:
+            subscription_id = 'free'
+            expires = None
         
-        # Check if month reset needed
         requests_used = row['requests_used']
-        last_reset_str = row['last_reset']
+        last_reset = row['last_reset']
         plan = get_plan(subscription_id)
         
-        if last_reset_str:
-            last_reset = datetime.strptime(last_reset_str, '%Y-%m-%d').date()
-            if current_date.month != last_reset.month or current_date.year > last_reset.year:
-                requests_used = 0
-                c.execute('UPDATE users SET requests_used = 0, last_reset = ? WHERE google_id = ?', 
-                          (current_date, google_id))
+        if last_reset and last_reset < current_date.replace(day=1).isoformat():
+            requests_used = 0
         
         return {
             'google_id': google_id,
@@ -304,26 +356,16 @@ def upgrade_user(google_id: str, plan_id: str) -> bool:
         c = conn.cursor()
         current_date = datetime.now().date()
         
-        expires = None
-        if plan_id == 'go_pro_plus':
-            expires = (datetime.now() + timedelta(days=365)).date()
-        elif plan_id == 'go_pro_ultra':
-            expires = (datetime.now() + timedelta(days=36500)).date() # 100 years = forever
-        elif plan['price'] > 0:
-            expires = (datetime.now() + timedelta(days=30)).date()
+        expires = get_plan_expiry(plan_id, plan)
         
-        c.execute('SELECT google_id FROM users WHERE google_id = ?', (google_id,))
-        if c.fetchone() is None:
-            c.execute('''
-                INSERT INTO users (google_id, requests_used, last_reset, subscription_id, subscription_expires)
-                VALUES (?, 0, ?, ?, ?)
-            ''', (google_id, current_date, plan_id, expires))
-        else:
-            c.execute('''
-                UPDATE users 
-                SET subscription_id = ?, subscription_expires = ?, requests_used = 0
-                WHERE google_id = ?
-            ''', (plan_id, expires, google_id))
+        c.execute('''
+            INSERT INTO users (google_id, requests_used, last_reset, subscription_id, subscription_expires)
+            VALUES (?, 0, ?, ?, ?)
+            ON CONFLICT(google_id) DO UPDATE SET
+                subscription_id = excluded.subscription_id,
+                subscription_expires = excluded.subscription_expires,
+                requests_used = 0
+        ''', (google_id, current_date, plan_id, expires))
         
         return True
 
@@ -333,24 +375,25 @@ def increment_usage(google_id: str, limit: int) -> bool:
         c = conn.cursor()
         current_time = time.time()
         
-        # Check last request time
-        c.execute('SELECT last_request_time, requests_used FROM users WHERE google_id = ?', (google_id,))
-        row = c.fetchone()
-        
-        if row and row['last_request_time']:
-            time_since_last = current_time - row['last_request_time']
-            if time_since_last < 2.0:
-                print(f"DEBUG: Duplicate request blocked for {google_id}")
-                return False
-        
-        # Increment and update timestamp atomically
+        # Quota check, duplicate-request guard (2 seconds) and increment in one atomic statement.
+        # A count from an earlier month starts over here, so the quota does not depend on the
+        # monthly reset job having run.
+        current_date = datetime.now().date()
+        month_start = current_date.replace(day=1).isoformat()
         c.execute('''
             UPDATE users 
-            SET requests_used = requests_used + 1, last_request_time = ? 
-            WHERE google_id = ? AND requests_used < ?
-        ''', (current_time, google_id, limit))
+            SET requests_used = CASE WHEN last_reset < ? THEN 1 ELSE requests_used + 1 END,
+                last_reset = CASE WHEN last_reset < ? THEN ? ELSE last_reset END,
+                last_request_time = ?
+            WHERE google_id = ? AND (requests_used < ? OR last_reset < ?)
+              AND ? - COALESCE(last_request_time, 0) >= 2.0
+        ''', (month_start, month_start, current_date.isoformat(), current_time, google_id, limit, month_start,
+              current_time))
         
-        return c.rowcount > 0
+        if c.rowcount == 0:
+            print(f"DEBUG: Request blocked for {google_id} (duplicate or quota reached)")
+            return False
+        return True
 def add_history_item(google_id: str, original: str, simplified: str, mode: str, url: str) -> bool:
     """Add a new history entry for the user"""
     with get_db() as conn:
@@ -372,4 +415,151 @@ def get_user_history(google_id: str, limit: int = 50, offset: int = 0) -> list:
             ORDER BY timestamp DESC 
             LIMIT ? OFFSET ?
         ''', (google_id, limit, offset))
-        return [dict(row) for row in c.fetchall()]
\ No newline at end of file
+        return [dict(row) for row in c.fetchall()]
+
+def iter_user_history(google_id: str, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """Yield a user's whole history, oldest first, as lists of dicts (index-ordered, no sort)"""
+    with get_readonly_db() as conn:
+        c = conn.cursor()
+        c.execute('''
+            SELECT original_text, simplified_text, mode, source_url, timestamp
+            FROM history
+            WHERE google_id = ?
+            ORDER BY timestamp
+        ''', (google_id,))
+        while True:
+            rows = c.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
+
+def add_history_items(google_id: str, items: list) -> int:
+    """Insert a batch of history entries in one transaction. Returns the number inserted."""
+    with get_db() as conn:
+        c = conn.cursor()
+        c.executemany('''
+            INSERT INTO history (google_id, original_text, simplified_text, mode, source_url, timestamp)
+            VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ''', [
+            (google_id, item['original_text'], item['simplified_text'],
+             item['mode'], item.get('source_url'), item.get('timestamp'))
+            for item in items
+        ])
+        return len(items)
+
+def record_usage(plan_id: str, mode: str, input_chars: int, output_chars: int) -> bool:
+    """Add one completed request to today's usage rollup"""
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO usage_daily (day, plan_id, mode, requests, input_chars, output_chars)
+            VALUES (?, ?, ?, 1, ?, ?)
+            ON CONFLICT (day, plan_id, mode) DO UPDATE SET
+                requests = requests + 1,
+                input_chars = input_chars + excluded.input_chars,
+                output_chars = output_chars + excluded.output_chars
+        ''', (datetime.now().date(), plan_id or 'free', mode, input_chars, output_chars))
+        return True
+
+def get_daily_usage(start: str = None, end: str = None) -> list:
+    """Requests and character totals per plan per day from the rollup table"""
+    with get_readonly_db() as conn:
+        c = conn.cursor()
+        c.execute('''
+            SELECT day, plan_id, SUM(requests) AS requests,
+                   SUM(input_chars) AS input_chars, SUM(output_chars) AS output_chars
+            FROM usage_daily
+            WHERE day >= COALESCE(?, day) AND day <= COALESCE(?, day)
+            GROUP BY day, plan_id
+            ORDER BY day DESC, plan_id
+        ''', (start, end))
+        return [dict(row) for row in c.fetchall()]
+
+def get_mode_usage(start: str = None, end: str = None) -> list:
+    """Request counts and average input/output length per mode from the rollup table"""
+    with get_readonly_db() as conn:
+        c = conn.cursor()
+        c.execute('''
+            SELECT mode, SUM(requests) AS requests,
+                   CAST(SUM(input_chars) AS REAL) / SUM(requests) AS avg_input_chars,
+                   CAST(SUM(output_chars) AS REAL) / SUM(requests) AS avg_output_chars
+            FROM usage_daily
+            WHERE day >= COALESCE(?, day) AND day <= COALESCE(?, day)
+            GROUP BY mode
+            ORDER BY requests DESC
+        ''', (start, end))
+        return [dict(row) for row in c.fetchall()]
+
+def get_plan_user_counts() -> list:
+    """Number of users on each plan (answered from idx_users_subscription)"""
+    with get_readonly_db() as conn:
+        c = conn.cursor()
+        c.execute('''
+            SELECT subscription_id AS plan_id, COUNT(*) AS users
+            FROM users
+            GROUP BY subscription_id
+            ORDER BY users DESC
+        ''')
+        return [dict(row) for row in c.fetchall()]
+
+def get_export_columns(table: str) -> list:
+    """(name, declared type) pairs for an exportable table"""
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Table {table} is not exportable")
+    with get_readonly_db() as conn:
+        rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
+        return [(row['name'], row['type']) for row in rows]
+
+def iter_table_rows(table: str, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """Yield an exportable table as lists of row tuples, chunk_size rows at a time"""
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Table {table} is not exportable")
+    with get_readonly_db() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT * FROM {table}")
+        while True:
+            rows = c.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [tuple(row) for row in rows]
+
+def expire_subscriptions(today) -> int:
+    """Downgrade every subscription that expired before today. Returns rows changed."""
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute('''
+            UPDATE users SET subscription_id = 'free', subscription_expires = NULL
+            WHERE subscription_expires < ? AND subscription_id != 'free'
+        ''', (today,))
+        return c.rowcount
+
+def reset_monthly_usage(today) -> int:
+    """Zero requests_used for everyone not yet reset this month. Returns rows changed."""
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute('''
+            UPDATE users SET requests_used = 0, last_reset = ?
+            WHERE last_reset < ?
+        ''', (today, today.replace(day=1)))
+        return c.rowcount
+
+def record_job_run(job: str, started_at: datetime, duration_ms: float, rows_affected: int) -> bool:
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO job_runs (job, started_at, duration_ms, rows_affected)
+            VALUES (?, ?, ?, ?)
+        ''', (job, started_at.strftime('%Y-%m-%d %H:%M:%S'), duration_ms, rows_affected))
+        return True
+
+def get_job_runs(limit: int = 50) -> list:
+    """Most recent scheduled job runs"""
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute('''
+            SELECT job, started_at, duration_ms, rows_affected
+            FROM job_runs
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (limit,))
+        return [dict(row) for row in c.fetchall()]
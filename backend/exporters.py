@@ -0,0 +1,87 @@
+import csv
+import io
+import json
+import zlib
+
+# Declared sqlite column types -> Arrow type names for Parquet exports
+ARROW_TYPES = {
+    'INTEGER': 'int64',
+    'REAL': 'float64',
+}
+
+def csv_chunks(columns: list, row_batches):
+    """Encode row batches as CSV, one text chunk per batch"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([name for name, _ in columns])
+    yield buf.getvalue()
+
+    for rows in row_batches:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows(rows)
+        yield buf.getvalue()
+
+class _ChunkSink(io.RawIOBase):
+    """Append-only file object that hands written bytes back to the caller"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def parquet_chunks(columns: list, row_batches):
+    """Encode row batches as a Parquet file, one row group per batch"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        (name, ARROW_TYPES.get((decl_type or '').upper(), 'string'))
+        for name, decl_type in columns
+    ])
+    # sqlite is loosely typed, so text columns may still hold numbers
+    text_columns = {i for i, field in enumerate(schema) if field.type == pa.string()}
+
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for rows in row_batches:
+            arrays = []
+            for i, values in enumerate(zip(*rows)):
+                if i in text_columns:
+                    values = [None if v is None else str(v) for v in values]
+                arrays.append(pa.array(values, type=schema.field(i).type))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    finally:
+        writer.close()
+    yield sink.drain()
+
+async def ndjson_chunks(row_batches, compress: bool = False):
+    """Encode async batches of dicts as NDJSON bytes, optionally as one gzip stream"""
+    gz = zlib.compressobj(wbits=31) if compress else None  # wbits=31 -> gzip container
+    async for rows in row_batches:
+        data = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode()
+        if gz:
+            data = gz.compress(data)
+        if data:
+            yield data
+    if gz:
+        yield gz.flush()
@@ -3,31 +3,52 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import openai
+import httpx
 import os
 from dotenv import load_dotenv
 import asyncio
+import json
+import zlib
+from datetime import datetime, timezone
 from typing import Optional
+from contextlib import asynccontextmanager
+
+# Load environment variables before the local modules read their settings at import time
+load_dotenv()
 
 # Local modules
 from database import (
-    init_db, 
-    get_user_subscription, 
-    increment_usage, 
-    get_all_plans, 
-    upgrade_user,
-    add_history_item,
-    get_user_history
+    get_all_plans,
+    HISTORY_IMPORT_BATCH_SIZE,
+    get_daily_usage,
+    get_mode_usage,
+    get_plan_user_counts,
+    get_export_columns,
+    iter_table_rows,
+    EXPORT_TABLES
 )
-from auth import verify_google_token
-
-# Load environment variables
-load_dotenv()
-
-# Initialize Database
-init_db()
+from storage import get_storage, SQLiteStorage
+from auth import verify_google_token, verify_admin_key
+from exporters import csv_chunks, parquet_chunks, ndjson_chunks
+from semantic_cache import near_dup_cache, context_key, fingerprint_text
+from memprofile import MEMORY_PROFILE, MemoryProfileMiddleware, memory_profiler
+from scheduler import SCHEDULER_ENABLED, run_scheduler
+
+# Initialize Storage (SQLite by default, PostgreSQL when DATABASE_URL is set)
+storage = get_storage()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await storage.init()
+    # Monthly resets and subscription expirations run here, not on the request path
+    scheduler_task = asyncio.create_task(run_scheduler(storage)) if SCHEDULER_ENABLED else None
+    yield
+    if scheduler_task:
+        scheduler_task.cancel()
+    await storage.close()
 
 # Initialize FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -38,6 +59,11 @@ app.add_middleware(
     allow_headers=["Content-Type", "Authorization", "X-Extension-ID"],
 )
 
+# Optional tracemalloc profiling per endpoint (MEMORY_PROFILE=1)
+if MEMORY_PROFILE:
+    memory_profiler.start()
+    app.add_middleware(MemoryProfileMiddleware, profiler=memory_profiler)
+
 # Initialize OpenAI
 api_key = os.getenv("OPENAI_API_KEY")
 if not api_key:
@@ -45,6 +71,13 @@ if not api_key:
 
 client = openai.OpenAI(api_key=api_key)
 
+# Per-request memory budget: the input is capped for every plan, the response by what max_tokens can produce
+MAX_INPUT_CHARS = int(os.getenv("MAX_INPUT_CHARS", "100000"))
+MAX_OUTPUT_TOKENS = 800
+# A gpt-4o-mini token averages about 4 characters; 8 leaves room for long tokens without
+# letting a runaway stream grow past what max_tokens should allow
+MAX_RESPONSE_CHARS = int(os.getenv("MAX_RESPONSE_CHARS", str(MAX_OUTPUT_TOKENS * 8)))
+
 class SimplifyRequest(BaseModel):
     text: str
     mode: str
@@ -60,6 +93,21 @@ class AISettings(BaseModel):
     points_count: int
     examples_count: int
 
+def release_stream(stream):
+    """Closes a model stream and frees the request body behind it.
+
+    The SDK's SSE generator and httpx's response/byte-stream pair both sit in reference cycles
+    that hold the sent request (the whole input text), so without this it lives until the next
+    full GC. Once the response is closed the generator only runs through what was already read.
+    """
+    stream.close()
+    try:
+        for _ in stream:
+            pass
+    except (httpx.HTTPError, openai.APIError):
+        pass
+    stream.response.stream = httpx.ByteStream(b"")
+
 def get_system_prompt(mode: str, settings: dict, language: str = 'ru') -> str:
     is_en = language == 'en'
     
@@ -117,33 +165,78 @@ def get_system_prompt(mode: str, settings: dict, language: str = 'ru') -> str:
         return f"{base_prompt} Simplify this text." if is_en else f"{base_prompt} Упрости этот текст."
 
 async def stream_generator(text: str, mode: str, settings: dict, google_id: str = None, url: str = None, plan_id: str = None, language: str = 'ru'):
-    full_response = ""
+    chunks = []
+    response_chars = 0
+    truncated = False
+    input_chars = len(text)
+    keep_text = bool(google_id) and plan_id not in ['free', 'go']
     try:
-        stream = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": get_system_prompt(mode, settings, language)},
-                {"role": "user", "content": text}
-            ],
-            max_tokens=800,
-            stream=True
-        )
-
-        for chunk in stream:
-            content = chunk.choices[0].delta.content
-            if content is not None:
-                full_response += content
-                yield content
-
-        # Save to history if user is GO+ or above
-        if google_id and full_response and plan_id not in ['free', 'go']:
-            add_history_item(google_id, text, full_response, mode, url)
+        # Reuse the output of a near-identical earlier request when there is one
+        context = context_key(mode, language, settings, google_id, plan_id)
+        fingerprint = await asyncio.to_thread(fingerprint_text, text)
+        cached = near_dup_cache.lookup(context, fingerprint)
+
+        # A sampled share of hits is regenerated anyway to score the cached output
+        audited = None
+        if cached is not None and near_dup_cache.should_sample_quality():
+            audited, cached = cached, None
+
+        if cached is not None:
+            chunks.append(cached)
+            yield cached
+        else:
+            stream = client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": get_system_prompt(mode, settings, language)},
+                    {"role": "user", "content": text}
+                ],
+                max_tokens=MAX_OUTPUT_TOKENS,
+                stream=True
+            )
+
+            try:
+                for chunk in stream:
+                    content = chunk.choices[0].delta.content
+                    if content is not None:
+                        response_chars += len(content)
+                        if response_chars > MAX_RESPONSE_CHARS:
+                            print(f"WARNING: response exceeded {MAX_RESPONSE_CHARS} chars, stream cut off")
+                            truncated = True
+                            break
+                        chunks.append(content)
+                        yield content
+            finally:
+                release_stream(stream)
+
+        full_response = "".join(chunks)
+        chunks = None
 
-    except Exception as e:
-        print(f"CRITICAL ERROR in stream_generator: {e}")
     except Exception as e:
         print(f"CRITICAL ERROR in stream_generator: {e}")
         yield get_error_message('system_error', language)
+        return
+
+    # The response has been delivered; bookkeeping failures are logged, never shown to the user
+    try:
+        # A cut-off response is neither cached nor kept in history
+        if not truncated:
+            if cached is None:
+                near_dup_cache.store(context, fingerprint, full_response)
+                if audited is not None and full_response:
+                    near_dup_cache.record_quality(audited, full_response)
+
+            # Save to history if user is GO+ or above
+            if keep_text and full_response:
+                await storage.add_history_item(google_id, text, full_response, mode, url)
+    except Exception as e:
+        print(f"ERROR saving response in stream_generator: {e}")
+
+    try:
+        if full_response:
+            await storage.record_usage(plan_id, mode, input_chars, len(full_response))
+    except Exception as e:
+        print(f"ERROR recording usage in stream_generator: {e}")
 
 # Error Messages Dictionary
 ERROR_MESSAGES = {
@@ -197,14 +290,14 @@ async def simplify_text(
         raise HTTPException(status_code=401, detail="Invalid session")
 
     # 2. Check Subscription & Limits
-    sub = get_user_subscription(user_info['id'], user_info['email'])
+    sub = await storage.get_user_subscription(user_info['id'], user_info['email'])
     
     # Check text length against plan limit
-    # Check text length against plan limit
-    if len(simplify_request.text) > sub['max_chars']:
+    max_chars = min(sub['max_chars'], MAX_INPUT_CHARS)
+    if len(simplify_request.text) > max_chars:
         raise HTTPException(
             status_code=400, 
-            detail=get_error_message('limit_chars', simplify_request.language, sub['max_chars'])
+            detail=get_error_message('limit_chars', simplify_request.language, max_chars)
         )
 
     # Check requests limit
@@ -223,7 +316,7 @@ async def simplify_text(
         )
 
     # 3. Increment Usage & Stream
-    increment_success = increment_usage(user_info['id'], sub['max_requests'])
+    increment_success = await storage.increment_usage(user_info['id'], sub['max_requests'])
     if not increment_success:
         raise HTTPException(
             status_code=429, 
@@ -260,13 +353,150 @@ async def get_history(
         raise HTTPException(status_code=401, detail="Invalid session")
     
     # Check if user has access to history (GO+ or above)
-    sub = get_user_subscription(user_info['id'], user_info['email'])
+    sub = await storage.get_user_subscription(user_info['id'], user_info['email'])
     if sub['plan_id'] in ['free', 'go']:
         return [] # Or raise error, but empty list is safer for UI
         
-    history = get_user_history(user_info['id'], limit, offset)
+    history = await storage.get_user_history(user_info['id'], limit, offset)
     return history
 
+@app.get("/history/export")
+async def export_history(
+    authorization: Optional[str] = Header(None),
+    x_extension_id: Optional[str] = Header(None),
+    format: str = "ndjson"
+):
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Authentication required")
+
+    token = authorization.split(" ")[1]
+    user_info = verify_google_token(token, x_extension_id)
+
+    if not user_info:
+        raise HTTPException(status_code=401, detail="Invalid session")
+
+    sub = await storage.get_user_subscription(user_info['id'], user_info['email'])
+    if sub['plan_id'] in ['free', 'go']:
+        raise HTTPException(status_code=403, detail="История доступна только в подписках GO + и выше")
+
+    if format not in ['ndjson', 'gzip']:
+        raise HTTPException(status_code=400, detail="Unsupported format")
+
+    compress = format == 'gzip'
+    filename = "history.ndjson.gz" if compress else "history.ndjson"
+    return StreamingResponse(
+        ndjson_chunks(storage.iter_user_history(user_info['id']), compress=compress),
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+# Limits for /history/import (sizes are after gzip decompression)
+HISTORY_IMPORT_MAX_BYTES = 256 * 1024 * 1024
+HISTORY_IMPORT_MAX_LINE_BYTES = 2 * 1024 * 1024
+HISTORY_IMPORT_BATCH_BYTES = 16 * 1024 * 1024
+DECOMPRESS_STEP_BYTES = 1024 * 1024
+
+def parse_history_line(line: bytes, line_number: int) -> dict:
+    """Validate one NDJSON history entry from an import"""
+    try:
+        item = json.loads(line)
+        entry = {
+            'original_text': item['original_text'],
+            'simplified_text': item['simplified_text'],
+            'mode': item['mode'],
+            'source_url': item.get('source_url'),
+            'timestamp': None
+        }
+        # Only strings reach the database (source_url may also be null)
+        if not all(isinstance(entry[key], str) for key in ('original_text', 'simplified_text', 'mode')):
+            raise TypeError("text fields must be strings")
+        if entry['source_url'] is not None and not isinstance(entry['source_url'], str):
+            raise TypeError("source_url must be a string")
+        if item.get('timestamp'):
+            timestamp = datetime.fromisoformat(str(item['timestamp']).replace('Z', '+00:00'))
+            # history.timestamp is UTC (CURRENT_TIMESTAMP); naive values are taken as UTC already
+            if timestamp.tzinfo is not None:
+                timestamp = timestamp.astimezone(timezone.utc)
+            entry['timestamp'] = timestamp.strftime('%Y-%m-%d %H:%M:%S')
+        return entry
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail=f"Invalid history entry on line {line_number}")
+
+async def iter_import_body(request: Request, gzip_body: bool):
+    """Request body in pieces, gunzipped at most DECOMPRESS_STEP_BYTES at a time, size-capped"""
+    gz = zlib.decompressobj(wbits=47) if gzip_body else None  # wbits=47 -> auto-detect gzip/zlib header
+    total = 0
+
+    def checked(piece: bytes) -> bytes:
+        nonlocal total
+        total += len(piece)
+        if total > HISTORY_IMPORT_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="Import is too large")
+        return piece
+
+    async for chunk in request.stream():
+        if gz is None:
+            yield checked(chunk)
+            continue
+        data = gz.decompress(chunk, DECOMPRESS_STEP_BYTES)
+        while data:
+            yield checked(data)
+            data = gz.decompress(gz.unconsumed_tail, DECOMPRESS_STEP_BYTES) if gz.unconsumed_tail else b""
+
+    if gz:
+        yield checked(gz.flush())
+
+@app.post("/history/import")
+async def import_history(
+    request: Request,
+    authorization: Optional[str] = Header(None),
+    x_extension_id: Optional[str] = Header(None)
+):
+    """Bulk import NDJSON history (plain or gzip). Batches written before an invalid line are kept."""
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Authentication required")
+
+    token = authorization.split(" ")[1]
+    user_info = verify_google_token(token, x_extension_id)
+
+    if not user_info:
+        raise HTTPException(status_code=401, detail="Invalid session")
+
+    sub = await storage.get_user_subscription(user_info['id'], user_info['email'])
+    if sub['plan_id'] in ['free', 'go']:
+        raise HTTPException(status_code=403, detail="История доступна только в подписках GO + и выше")
+
+    gzip_body = request.headers.get('content-encoding') == 'gzip' or request.headers.get('content-type') == 'application/gzip'
+
+    imported = 0
+    line_number = 0
+    batch = []
+    batch_bytes = 0
+    pending = b""
+    async for piece in iter_import_body(request, gzip_body):
+        lines = (pending + piece).split(b"\n")
+        pending = lines.pop()
+        if len(pending) > HISTORY_IMPORT_MAX_LINE_BYTES:
+            raise HTTPException(status_code=413, detail=f"Line {line_number + len(lines) + 1} is too long")
+        for line in lines:
+            line_number += 1
+            if len(line) > HISTORY_IMPORT_MAX_LINE_BYTES:
+                raise HTTPException(status_code=413, detail=f"Line {line_number} is too long")
+            if line.strip():
+                batch.append(parse_history_line(line, line_number))
+                batch_bytes += len(line)
+            if len(batch) >= HISTORY_IMPORT_BATCH_SIZE or batch_bytes >= HISTORY_IMPORT_BATCH_BYTES:
+                imported += await storage.add_history_items(user_info['id'], batch)
+                batch = []
+                batch_bytes = 0
+
+    if pending.strip():
+        batch.append(parse_history_line(pending, line_number + 1))
+    if batch:
+        imported += await storage.add_history_items(user_info['id'], batch)
+
+    return {"status": "success", "imported": imported}
+
 @app.get("/me")
 async def get_me(
     authorization: Optional[str] = Header(None),
@@ -281,7 +511,7 @@ async def get_me(
     if not user_info:
         raise HTTPException(status_code=401, detail="Invalid session")
 
-    return get_user_subscription(user_info['id'], user_info['email'])
+    return await storage.get_user_subscription(user_info['id'], user_info['email'])
 
 @app.get("/settings")
 async def get_user_settings_route(
@@ -296,7 +526,7 @@ async def get_user_settings_route(
     if not user_info:
         raise HTTPException(status_code=401, detail="Invalid session")
 
-    sub = get_user_subscription(user_info['id'], user_info['email'])
+    sub = await storage.get_user_subscription(user_info['id'], user_info['email'])
     return sub['settings']
 
 @app.post("/settings")
@@ -313,12 +543,11 @@ async def update_user_settings_route(
     if not user_info:
         raise HTTPException(status_code=401, detail="Invalid session")
 
-    sub = get_user_subscription(user_info['id'], user_info['email'])
+    sub = await storage.get_user_subscription(user_info['id'], user_info['email'])
     if not sub['ai_settings_enabled']:
         raise HTTPException(status_code=403, detail="Настройки AI доступны только в плане GO")
 
-    from database import update_user_settings
-    success = update_user_settings(user_info['id'], settings.dict())
+    success = await storage.update_user_settings(user_info['id'], settings.dict())
     if not success:
         raise HTTPException(status_code=500, detail="Ошибка при сохранении настроек")
     
@@ -342,12 +571,91 @@ async def upgrade_plan(
     if not user_info:
         raise HTTPException(status_code=401, detail="Invalid session")
 
-    success = upgrade_user(user_info['id'], upgrade_request.plan_id)
+    success = await storage.upgrade_user(user_info['id'], upgrade_request.plan_id)
     if not success:
         raise HTTPException(status_code=400, detail="Ошибка при обновлении плана")
     
     return {"status": "success"}
 
+def require_admin(x_admin_key: Optional[str]):
+    if not verify_admin_key(x_admin_key):
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+def require_sqlite_analytics():
+    # Rollup reads and exports go through the local sqlite file
+    if not isinstance(storage, SQLiteStorage):
+        raise HTTPException(status_code=501, detail="Analytics are only available on the SQLite backend")
+
+@app.get("/admin/stats/daily")
+async def admin_daily_stats(
+    x_admin_key: Optional[str] = Header(None),
+    start: Optional[str] = None,
+    end: Optional[str] = None
+):
+    require_admin(x_admin_key)
+    require_sqlite_analytics()
+    return await asyncio.to_thread(get_daily_usage, start, end)
+
+@app.get("/admin/stats/modes")
+async def admin_mode_stats(
+    x_admin_key: Optional[str] = Header(None),
+    start: Optional[str] = None,
+    end: Optional[str] = None
+):
+    require_admin(x_admin_key)
+    require_sqlite_analytics()
+    return await asyncio.to_thread(get_mode_usage, start, end)
+
+@app.get("/admin/stats/plans")
+async def admin_plan_stats(x_admin_key: Optional[str] = Header(None)):
+    require_admin(x_admin_key)
+    require_sqlite_analytics()
+    return await asyncio.to_thread(get_plan_user_counts)
+
+@app.get("/admin/export/{table}")
+async def admin_export(
+    table: str,
+    x_admin_key: Optional[str] = Header(None),
+    format: str = "csv"
+):
+    require_admin(x_admin_key)
+    require_sqlite_analytics()
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail="Unknown table")
+
+    columns = await asyncio.to_thread(get_export_columns, table)
+    if format == "csv":
+        body = csv_chunks(columns, iter_table_rows(table))
+        media_type = "text/csv"
+    elif format == "parquet":
+        body = parquet_chunks(columns, iter_table_rows(table))
+        media_type = "application/vnd.apache.parquet"
+    else:
+        raise HTTPException(status_code=400, detail="Unsupported format")
+
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'}
+    )
+
+@app.get("/admin/cache/stats")
+async def admin_cache_stats(x_admin_key: Optional[str] = Header(None)):
+    require_admin(x_admin_key)
+    return near_dup_cache.get_stats()
+
+@app.get("/admin/jobs")
+async def admin_job_runs(x_admin_key: Optional[str] = Header(None), limit: int = 50):
+    require_admin(x_admin_key)
+    return await storage.get_job_runs(limit)
+
+@app.get("/admin/memory")
+async def admin_memory_stats(x_admin_key: Optional[str] = Header(None)):
+    require_admin(x_admin_key)
+    if not MEMORY_PROFILE:
+        raise HTTPException(status_code=404, detail="Memory profiling is disabled (set MEMORY_PROFILE=1)")
+    return memory_profiler.get_stats()
+
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
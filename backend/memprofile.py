@@ -0,0 +1,76 @@
+import os
+import tracemalloc
+
+# Debug-only: snapshots the whole Python heap around every request
+MEMORY_PROFILE = os.getenv("MEMORY_PROFILE") == "1"
+MEMORY_PROFILE_TOP = 10
+
+class MemoryProfiler:
+    """Per-endpoint allocation stats collected with tracemalloc"""
+
+    def __init__(self):
+        self.endpoints = {}
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def record(self, endpoint: str, growth: int, net: int, top: list):
+        stats = self.endpoints.setdefault(endpoint, {
+            'requests': 0,
+            'max_growth_bytes': 0,
+            'total_net_bytes': 0,
+            'top_allocations': []
+        })
+        stats['requests'] += 1
+        stats['total_net_bytes'] += net
+        if growth >= stats['max_growth_bytes']:
+            # Keep the allocation diff of the worst request seen so far
+            stats['max_growth_bytes'] = growth
+            stats['top_allocations'] = top
+
+    def get_stats(self) -> dict:
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'traced_current_bytes': current,
+            'traced_peak_bytes': peak,
+            'endpoints': self.endpoints
+        }
+
+class MemoryProfileMiddleware:
+    """ASGI middleware that diffs tracemalloc snapshots from request start to the last body chunk.
+
+    Growth is sampled on every response message, so streaming endpoints are measured
+    until the stream ends rather than when the response headers go out. Concurrent
+    requests share one heap, so numbers are indicative, not exact.
+    """
+
+    def __init__(self, app, profiler: MemoryProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        before = tracemalloc.take_snapshot()
+        start = tracemalloc.get_traced_memory()[0]
+        growth = 0
+
+        async def profiled_send(message):
+            nonlocal growth
+            growth = max(growth, tracemalloc.get_traced_memory()[0] - start)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, profiled_send)
+        finally:
+            after = tracemalloc.take_snapshot()
+            net = tracemalloc.get_traced_memory()[0] - start
+            top = [str(diff) for diff in after.compare_to(before, 'lineno')[:MEMORY_PROFILE_TOP]]
+            route = scope.get("route")
+            endpoint = f"{scope['method']} {getattr(route, 'path', scope['path'])}"
+            self.profiler.record(endpoint, max(growth, net), net, top)
+
+memory_profiler = MemoryProfiler()
@@ -0,0 +1,42 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+# Set to 0 on all but one worker/host if you don't want every process running the jobs
+# (they are idempotent, so running them more than once is harmless)
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1") == "1"
+
+# Jobs run at startup and then shortly after every local midnight
+MIDNIGHT_DELAY_SECONDS = 5
+
+# Storage methods run as jobs, in order
+JOBS = ['expire_subscriptions', 'reset_monthly_usage']
+
+async def run_jobs(storage):
+    """Run every job once as a set-based UPDATE and log its duration and row count"""
+    today = datetime.now().date()
+    for name in JOBS:
+        started_at = datetime.now()
+        start = time.perf_counter()
+        try:
+            rows = await getattr(storage, name)(today)
+        except Exception as e:
+            print(f"CRITICAL ERROR in scheduled job {name}: {e}")
+            continue
+        duration_ms = (time.perf_counter() - start) * 1000
+        print(f"Job {name}: {rows} rows in {duration_ms:.1f} ms")
+        await storage.record_job_run(name, started_at, duration_ms, rows)
+
+def seconds_until_next_run(now: datetime) -> float:
+    next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return (next_midnight - now).total_seconds() + MIDNIGHT_DELAY_SECONDS
+
+async def run_scheduler(storage):
+    """Background loop started from the app lifespan"""
+    while True:
+        try:
+            await run_jobs(storage)
+        except Exception as e:
+            print(f"CRITICAL ERROR in scheduler: {e}")
+        await asyncio.sleep(seconds_until_next_run(datetime.now()))
@@ -0,0 +1,255 @@
+import difflib
+import hashlib
+import heapq
+import os
+import random
+import re
+from collections import OrderedDict, defaultdict, namedtuple
+
+# Max number of cached outputs (0 disables the cache)
+NEAR_DUP_CACHE_SIZE = int(os.getenv("NEAR_DUP_CACHE_SIZE", "5000"))
+
+# Max total characters of cached outputs; least recently used entries go first
+NEAR_DUP_CACHE_MAX_CHARS = int(os.getenv("NEAR_DUP_CACHE_MAX_CHARS", "5000000"))
+
+# Who may reuse whose outputs: 'user' (default), 'plan' or 'global'
+NEAR_DUP_CACHE_SCOPE = os.getenv("NEAR_DUP_CACHE_SCOPE", "user")
+
+# Share of cache hits that are regenerated anyway to measure how far the cached output drifts
+QUALITY_SAMPLE_RATE = float(os.getenv("NEAR_DUP_QUALITY_SAMPLE_RATE", "0.02"))
+
+# Minimum SimHash similarity (1 - hamming/64) for reusing an output, per mode.
+# Modes that summarize tolerate more drift than modes that paraphrase sentence by sentence.
+SIMILARITY_THRESHOLDS = {
+    'simple': 0.94,
+    'short': 0.9,
+    'key_points': 0.9,
+    'examples': 0.94
+}
+DEFAULT_THRESHOLD = 0.95
+
+# SimHash only selects candidates; a fuzzy hit must also pass this token-set Jaccard check
+MIN_TOKEN_JACCARD = 0.9
+
+# A different count of these tokens flips meaning, so it always vetoes a fuzzy hit
+# ("isn't" tokenizes to "isn", "t")
+NEGATION_TOKENS = frozenset({
+    'not', 'no', 'never', 'nor', 'none', 'nothing', 'without', 'cannot', 't',
+    'не', 'нет', 'ни', 'без', 'никогда', 'ничего'
+})
+
+# Texts with fewer tokens than this only match exactly (after normalization)
+MIN_FUZZY_TOKENS = 12
+
+# Token sets are kept as a bottom-k sketch of token hashes, so an entry stays small for any input size
+SKETCH_SIZE = 256
+
+FINGERPRINT_BITS = 64
+SHINGLE_SIZE = 3
+# 8 bands of 8 bits: any pair within hamming distance 7 shares at least one band
+BANDS = 8
+BAND_BITS = FINGERPRINT_BITS // BANDS
+
+CITATION_RE = re.compile(r"\[\s*(\d+|citation needed)\s*\]", re.IGNORECASE)
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# simhash selects candidates; digest, sketch and negations verify them
+Fingerprint = namedtuple('Fingerprint', ['simhash', 'token_count', 'digest', 'sketch', 'negations'])
+
+def tokenize(text: str) -> list:
+    """Lowercased word tokens with citation markers like [12] stripped"""
+    return TOKEN_RE.findall(CITATION_RE.sub(" ", text).lower())
+
+def token_hash(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), 'big')
+
+def token_sketch(tokens) -> frozenset:
+    """The SKETCH_SIZE smallest distinct token hashes"""
+    return frozenset(heapq.nsmallest(SKETCH_SIZE, {token_hash(token) for token in set(tokens)}))
+
+def simhash(tokens: list) -> int:
+    """64-bit SimHash over word shingles"""
+    if len(tokens) < SHINGLE_SIZE:
+        shingles = [" ".join(tokens)]
+    else:
+        shingles = [" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)]
+
+    hashes = [format(token_hash(shingle), '064b') for shingle in shingles]
+
+    # Transposing the bit strings counts each bit position in C instead of a per-bit Python loop
+    bits = "".join('1' if 2 * column.count('1') > len(hashes) else '0' for column in zip(*hashes))
+    return int(bits, 2)
+
+def fingerprint_text(text: str) -> Fingerprint:
+    """Computed once per request; CPU-bound for long texts, so callers run it off the event loop"""
+    tokens = tokenize(text)
+    digest = hashlib.blake2b(" ".join(tokens).encode(), digest_size=16).digest()
+    negations = tuple(sorted((token, tokens.count(token)) for token in NEGATION_TOKENS.intersection(tokens)))
+    return Fingerprint(simhash(tokens), len(tokens), digest, token_sketch(tokens), negations)
+
+def similarity(a: int, b: int) -> float:
+    return 1.0 - bin(a ^ b).count("1") / FINGERPRINT_BITS
+
+def jaccard(a: frozenset, b: frozenset) -> float:
+    """Token-set Jaccard estimated from two bottom-k sketches (exact for small sets)"""
+    union = heapq.nsmallest(SKETCH_SIZE, a | b)
+    if not union:
+        return 1.0
+    return sum(1 for h in union if h in a and h in b) / len(union)
+
+def output_similarity(a: str, b: str) -> float:
+    """Diff ratio between two model outputs, over normalized tokens"""
+    return difflib.SequenceMatcher(None, tokenize(a), tokenize(b), autojunk=False).ratio()
+
+def context_key(mode: str, language: str, settings: dict, google_id: str = None, plan_id: str = None) -> tuple:
+    """Everything besides the input text that decides whether an output may be reused"""
+    if NEAR_DUP_CACHE_SCOPE == 'global':
+        scope = None
+    elif NEAR_DUP_CACHE_SCOPE == 'plan':
+        scope = plan_id
+    else:
+        scope = google_id
+    return (
+        mode,
+        language,
+        settings.get('simple_level'),
+        settings.get('short_level'),
+        settings.get('points_count'),
+        settings.get('examples_count'),
+        scope
+    )
+
+class NearDuplicateCache:
+    """In-memory LRU of model outputs, looked up by SimHash with LSH banding"""
+
+    def __init__(self, max_entries: int = NEAR_DUP_CACHE_SIZE, quality_sample_rate: float = QUALITY_SAMPLE_RATE,
+                 max_chars: int = NEAR_DUP_CACHE_MAX_CHARS):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.total_chars = 0
+        self.quality_sample_rate = quality_sample_rate
+        self.entries = OrderedDict()  # entry id -> (context, Fingerprint, output)
+        self.buckets = defaultdict(set)  # (context, band, band value) -> entry ids
+        self.exact = {}  # (context, token digest) -> entry id
+        self.next_id = 0
+        self.stats = {
+            'lookups': 0,
+            'hits': 0,
+            'exact_hits': 0,
+            'misses': 0,
+            'rejected_by_verifier': 0,
+            'stores': 0,
+            'evictions': 0,
+            'hit_similarity_sum': 0.0,
+            'hit_similarity_min': None,
+            'quality_samples': 0,
+            'quality_score_sum': 0.0,
+            'quality_score_min': None
+        }
+
+    def _bands(self, simhash_value: int):
+        mask = (1 << BAND_BITS) - 1
+        for band in range(BANDS):
+            yield band, (simhash_value >> (band * BAND_BITS)) & mask
+
+    def _verify(self, fp: Fingerprint, candidate: Fingerprint) -> bool:
+        """Token-level check behind a SimHash match"""
+        if jaccard(fp.sketch, candidate.sketch) < MIN_TOKEN_JACCARD:
+            return False
+        return fp.negations == candidate.negations
+
+    def lookup(self, context: tuple, fp: Fingerprint):
+        """Cached output for the closest verified input above the mode threshold, or None"""
+        if not self.max_entries:
+            return None
+        self.stats['lookups'] += 1
+
+        # Exact hits need the same normalized text, not merely the same SimHash
+        best_id, best_score = self.exact.get((context, fp.digest)), 1.0
+        if best_id is None and fp.token_count >= MIN_FUZZY_TOKENS:
+            best_score = SIMILARITY_THRESHOLDS.get(context[0], DEFAULT_THRESHOLD)
+            candidates = set()
+            for band, value in self._bands(fp.simhash):
+                candidates.update(self.buckets.get((context, band, value), ()))
+            for entry_id in candidates:
+                candidate = self.entries[entry_id][1]
+                # A near-duplicate has about the same length
+                if abs(candidate.token_count - fp.token_count) > max(3, fp.token_count // 10):
+                    continue
+                score = similarity(fp.simhash, candidate.simhash)
+                if score < best_score:
+                    continue
+                if not self._verify(fp, candidate):
+                    self.stats['rejected_by_verifier'] += 1
+                    continue
+                best_id, best_score = entry_id, score
+
+        if best_id is None:
+            self.stats['misses'] += 1
+            return None
+
+        self.entries.move_to_end(best_id)
+        self.stats['hits'] += 1
+        if (context, fp.digest) in self.exact:
+            self.stats['exact_hits'] += 1
+        self.stats['hit_similarity_sum'] += best_score
+        if self.stats['hit_similarity_min'] is None or best_score < self.stats['hit_similarity_min']:
+            self.stats['hit_similarity_min'] = best_score
+        return self.entries[best_id][2]
+
+    def should_sample_quality(self) -> bool:
+        """Whether to regenerate this hit and score the cached output against the fresh one"""
+        return random.random() < self.quality_sample_rate
+
+    def record_quality(self, cached_output: str, fresh_output: str) -> float:
+        score = output_similarity(cached_output, fresh_output)
+        self.stats['quality_samples'] += 1
+        self.stats['quality_score_sum'] += score
+        if self.stats['quality_score_min'] is None or score < self.stats['quality_score_min']:
+            self.stats['quality_score_min'] = score
+        return score
+
+    def store(self, context: tuple, fp: Fingerprint, output: str):
+        if not self.max_entries or not output or len(output) > self.max_chars:
+            return
+
+        existing = self.exact.get((context, fp.digest))
+        if existing is not None:
+            self._remove(existing)
+
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entries[entry_id] = (context, fp, output)
+        self.total_chars += len(output)
+        self.exact[(context, fp.digest)] = entry_id
+        for band, value in self._bands(fp.simhash):
+            self.buckets[(context, band, value)].add(entry_id)
+        self.stats['stores'] += 1
+
+        while len(self.entries) > self.max_entries or self.total_chars > self.max_chars:
+            self._remove(next(iter(self.entries)))
+            self.stats['evictions'] += 1
+
+    def _remove(self, entry_id: int):
+        context, fp, output = self.entries.pop(entry_id)
+        self.total_chars -= len(output)
+        if self.exact.get((context, fp.digest)) == entry_id:
+            del self.exact[(context, fp.digest)]
+        for band, value in self._bands(fp.simhash):
+            bucket = self.buckets[(context, band, value)]
+            bucket.discard(entry_id)
+            if not bucket:
+                del self.buckets[(context, band, value)]
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        similarity_sum = stats.pop('hit_similarity_sum')
+        quality_sum = stats.pop('quality_score_sum')
+        stats['entries'] = len(self.entries)
+        stats['chars'] = self.total_chars
+        stats['hit_rate'] = stats['hits'] / stats['lookups'] if stats['lookups'] else 0.0
+        stats['hit_similarity_avg'] = similarity_sum / stats['hits'] if stats['hits'] else None
+        stats['quality_score_avg'] = quality_sum / stats['quality_samples'] if stats['quality_samples'] else None
+        return stats
+
+near_dup_cache = NearDuplicateCache()
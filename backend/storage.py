@@ -0,0 +1,461 @@
+import asyncio
+import os
+import time
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+
+import database
+from database import SUBSCRIPTION_PLANS, EXPORT_CHUNK_SIZE, get_plan, get_plan_expiry
+
+class Storage(ABC):
+    """Persistence interface used by the API. All methods are coroutines."""
+
+    @abstractmethod
+    async def init(self):
+        ...
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def get_user_subscription(self, google_id: str, email: str = None) -> dict:
+        ...
+
+    @abstractmethod
+    async def increment_usage(self, google_id: str, limit: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def upgrade_user(self, google_id: str, plan_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def update_user_settings(self, google_id: str, settings: dict) -> bool:
+        ...
+
+    @abstractmethod
+    async def add_history_item(self, google_id: str, original: str, simplified: str, mode: str, url: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def get_user_history(self, google_id: str, limit: int = 50, offset: int = 0) -> list:
+        ...
+
+    @abstractmethod
+    def iter_user_history(self, google_id: str, chunk_size: int = EXPORT_CHUNK_SIZE):
+        """Async iterator over a user's whole history, oldest first, in lists of dicts"""
+
+    @abstractmethod
+    async def add_history_items(self, google_id: str, items: list) -> int:
+        ...
+
+    @abstractmethod
+    async def record_usage(self, plan_id: str, mode: str, input_chars: int, output_chars: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def expire_subscriptions(self, today: date) -> int:
+        ...
+
+    @abstractmethod
+    async def reset_monthly_usage(self, today: date) -> int:
+        ...
+
+    @abstractmethod
+    async def record_job_run(self, job: str, started_at: datetime, duration_ms: float, rows_affected: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def get_job_runs(self, limit: int = 50) -> list:
+        ...
+
+class SQLiteStorage(Storage):
+    """The original sqlite3 persistence in database.py, run off the event loop"""
+
+    async def init(self):
+        await asyncio.to_thread(database.init_db)
+
+    async def get_user_subscription(self, google_id: str, email: str = None) -> dict:
+        return await asyncio.to_thread(database.get_user_subscription, google_id, email)
+
+    async def increment_usage(self, google_id: str, limit: int) -> bool:
+        return await asyncio.to_thread(database.increment_usage, google_id, limit)
+
+    async def upgrade_user(self, google_id: str, plan_id: str) -> bool:
+        return await asyncio.to_thread(database.upgrade_user, google_id, plan_id)
+
+    async def update_user_settings(self, google_id: str, settings: dict) -> bool:
+        return await asyncio.to_thread(database.update_user_settings, google_id, settings)
+
+    async def add_history_item(self, google_id: str, original: str, simplified: str, mode: str, url: str) -> bool:
+        return await asyncio.to_thread(database.add_history_item, google_id, original, simplified, mode, url)
+
+    async def get_user_history(self, google_id: str, limit: int = 50, offset: int = 0) -> list:
+        return await asyncio.to_thread(database.get_user_history, google_id, limit, offset)
+
+    async def iter_user_history(self, google_id: str, chunk_size: int = EXPORT_CHUNK_SIZE):
+        batches = database.iter_user_history(google_id, chunk_size)
+        fetch = None
+        try:
+            while True:
+                # Shielded so a client disconnect cannot abandon the worker thread mid-next()
+                fetch = asyncio.ensure_future(asyncio.to_thread(next, batches, None))
+                batch = await asyncio.shield(fetch)
+                fetch = None
+                if batch is None:
+                    break
+                yield batch
+        finally:
+            if fetch is not None:
+                # The generator can only be closed once the thread has left it
+                await asyncio.wait([fetch])
+            await asyncio.to_thread(batches.close)
+
+    async def add_history_items(self, google_id: str, items: list) -> int:
+        return await asyncio.to_thread(database.add_history_items, google_id, items)
+
+    async def record_usage(self, plan_id: str, mode: str, input_chars: int, output_chars: int) -> bool:
+        return await asyncio.to_thread(database.record_usage, plan_id, mode, input_chars, output_chars)
+
+    async def expire_subscriptions(self, today: date) -> int:
+        return await asyncio.to_thread(database.expire_subscriptions, today)
+
+    async def reset_monthly_usage(self, today: date) -> int:
+        return await asyncio.to_thread(database.reset_monthly_usage, today)
+
+    async def record_job_run(self, job: str, started_at: datetime, duration_ms: float, rows_affected: int) -> bool:
+        return await asyncio.to_thread(database.record_job_run, job, started_at, duration_ms, rows_affected)
+
+    async def get_job_runs(self, limit: int = 50) -> list:
+        return await asyncio.to_thread(database.get_job_runs, limit)
+
+PG_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS subscription_plans (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        max_chars INTEGER DEFAULT 5000,
+        max_requests INTEGER DEFAULT 15,
+        ai_settings_enabled INTEGER DEFAULT 0,
+        price DOUBLE PRECISION DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        google_id TEXT PRIMARY KEY,
+        email TEXT,
+        requests_used INTEGER DEFAULT 0,
+        last_reset DATE,
+        last_request_time DOUBLE PRECISION DEFAULT 0,
+        subscription_id TEXT DEFAULT 'free',
+        subscription_expires DATE,
+        setting_simple_level INTEGER DEFAULT 5,
+        setting_short_level INTEGER DEFAULT 5,
+        setting_points_count INTEGER DEFAULT 5,
+        setting_examples_count INTEGER DEFAULT 2
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS history (
+        id BIGSERIAL PRIMARY KEY,
+        google_id TEXT NOT NULL REFERENCES users (google_id),
+        original_text TEXT,
+        simplified_text TEXT,
+        mode TEXT,
+        source_url TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS usage_daily (
+        day DATE NOT NULL,
+        plan_id TEXT NOT NULL,
+        mode TEXT NOT NULL,
+        requests BIGINT DEFAULT 0,
+        input_chars BIGINT DEFAULT 0,
+        output_chars BIGINT DEFAULT 0,
+        PRIMARY KEY (day, plan_id, mode)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_history_user_time ON history (google_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_users_subscription ON users (subscription_id)',
+    'CREATE INDEX IF NOT EXISTS idx_users_last_reset ON users (last_reset)',
+    'CREATE INDEX IF NOT EXISTS idx_users_subscription_expires ON users (subscription_expires)',
+    '''
+    CREATE TABLE IF NOT EXISTS job_runs (
+        id BIGSERIAL PRIMARY KEY,
+        job TEXT NOT NULL,
+        started_at TIMESTAMP NOT NULL,
+        duration_ms DOUBLE PRECISION NOT NULL,
+        rows_affected INTEGER NOT NULL
+    )
+    ''',
+]
+
+class PostgresStorage(Storage):
+    """PostgreSQL persistence over an asyncpg connection pool"""
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool = None
+
+    async def init(self):
+        import asyncpg
+
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            # Connection pool bounds, read here so a .env loaded after import still applies
+            min_size=int(os.getenv("PG_POOL_MIN_SIZE", "1")),
+            max_size=int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+        )
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Serialize schema setup between workers starting at the same time
+                await conn.execute('SELECT pg_advisory_xact_lock(hashtext(\'simplifier_schema\'))')
+                for statement in PG_SCHEMA:
+                    await conn.execute(statement)
+                await conn.executemany('''
+                    INSERT INTO subscription_plans
+                    (id, name, max_chars, max_requests, ai_settings_enabled, price)
+                    VALUES ($1, $2, $3, $4, $5, $6)
+                    ON CONFLICT (id) DO UPDATE SET
+                        name = excluded.name, max_chars = excluded.max_chars,
+                        max_requests = excluded.max_requests,
+                        ai_settings_enabled = excluded.ai_settings_enabled, price = excluded.price
+                ''', [
+                    (p['id'], p['name'], p['max_chars'], p['max_requests'],
+                     1 if p['ai_settings_enabled'] else 0, float(p['price']))
+                    for p in SUBSCRIPTION_PLANS.values()
+                ])
+            rows = await conn.fetch('SELECT * FROM subscription_plans ORDER BY price ASC')
+
+        # Plans are served from the shared cache in database.py
+        database.PLAN_CACHE = {row['id']: dict(row) for row in rows}
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+
+    async def get_user_subscription(self, google_id: str, email: str = None) -> dict:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow('''
+                    SELECT u.*,
+                           p.name as plan_name, p.max_chars, p.max_requests, p.ai_settings_enabled, p.price
+                    FROM users u
+                    LEFT JOIN subscription_plans p ON u.subscription_id = p.id
+                    WHERE u.google_id = $1
+                ''', google_id)
+
+                current_date = datetime.now().date()
+
+                if row is None:
+                    # New user
+                    await conn.execute('''
+                        INSERT INTO users (google_id, email, requests_used, last_reset, subscription_id)
+                        VALUES ($1, $2, 0, $3, 'free')
+                        ON CONFLICT (google_id) DO NOTHING
+                    ''', google_id, email, current_date)
+
+                    plan = get_plan('free')
+                    return {
+                        'google_id': google_id,
+                        'email': email,
+                        'plan_id': 'free',
+                        'plan_name': plan['name'],
+                        'requests_used': 0,
+                        'max_requests': plan['max_requests'],
+                        'max_chars': plan['max_chars'],
+                        'ai_settings_enabled': bool(plan['ai_settings_enabled']),
+                        'expires': None,
+                        'settings': {
+                            'simple_level': 5,
+                            'short_level': 5,
+                            'points_count': 5,
+                            'examples_count': 2
+                        }
+                    }
+
+                # Sync email
+                if email and row['email'] != email:
+                    await conn.execute('UPDATE users SET email = $1 WHERE google_id = $2', email, google_id)
+
+                # Expirations and monthly resets are written by the scheduled jobs;
+                # only report the effective state in case a job has not run yet
+                subscription_id = row['subscription_id'] or 'free'
+                expires = row['subscription_expires']
+
+                if expires and subscription_id != 'free' and current_date > expires:
+                    subscription_id = 'free'
+                    expires = None
+
+                requests_used = row['requests_used']
+                last_reset = row['last_reset']
+                plan = get_plan(subscription_id)
+
+                if last_reset and last_reset < current_date.replace(day=1):
+                    requests_used = 0
+
+                return {
+                    'google_id': google_id,
+                    'email': email or row['email'],
+                    'plan_id': subscription_id,
+                    'plan_name': plan['name'],
+                    'requests_used': requests_used,
+                    'max_requests': plan['max_requests'],
+                    'max_chars': plan['max_chars'],
+                    'ai_settings_enabled': bool(plan['ai_settings_enabled']),
+                    'expires': expires.isoformat() if expires else None,
+                    'settings': {
+                        'simple_level': row['setting_simple_level'],
+                        'short_level': row['setting_short_level'],
+                        'points_count': row['setting_points_count'],
+                        'examples_count': row['setting_examples_count']
+                    }
+                }
+
+    async def increment_usage(self, google_id: str, limit: int) -> bool:
+        # Quota check, duplicate-request guard and increment in one atomic statement;
+        # a count from an earlier month starts over without waiting for the reset job
+        current_time = time.time()
+        current_date = datetime.now().date()
+        row = await self.pool.fetchrow('''
+            UPDATE users
+            SET requests_used = CASE WHEN last_reset < $4 THEN 1 ELSE requests_used + 1 END,
+                last_reset = CASE WHEN last_reset < $4 THEN $5 ELSE last_reset END,
+                last_request_time = $1
+            WHERE google_id = $2 AND (requests_used < $3 OR last_reset < $4)
+              AND $1 - COALESCE(last_request_time, 0) >= 2.0
+            RETURNING requests_used
+        ''', current_time, google_id, limit, current_date.replace(day=1), current_date)
+        return row is not None
+
+    async def upgrade_user(self, google_id: str, plan_id: str) -> bool:
+        plan = get_plan(plan_id)
+        if not plan:
+            return False
+
+        await self.pool.execute('''
+            INSERT INTO users (google_id, requests_used, last_reset, subscription_id, subscription_expires)
+            VALUES ($1, 0, $2, $3, $4)
+            ON CONFLICT (google_id) DO UPDATE SET
+                subscription_id = excluded.subscription_id,
+                subscription_expires = excluded.subscription_expires,
+                requests_used = 0
+        ''', google_id, datetime.now().date(), plan_id, get_plan_expiry(plan_id, plan))
+        return True
+
+    async def update_user_settings(self, google_id: str, settings: dict) -> bool:
+        result = await self.pool.execute('''
+            UPDATE users SET
+                setting_simple_level = $1,
+                setting_short_level = $2,
+                setting_points_count = $3,
+                setting_examples_count = $4
+            WHERE google_id = $5
+        ''',
+            settings.get('simple_level', 5),
+            settings.get('short_level', 5),
+            settings.get('points_count', 5),
+            settings.get('examples_count', 2),
+            google_id
+        )
+        return result != 'UPDATE 0'
+
+    async def add_history_item(self, google_id: str, original: str, simplified: str, mode: str, url: str) -> bool:
+        await self.pool.execute('''
+            INSERT INTO history (google_id, original_text, simplified_text, mode, source_url)
+            VALUES ($1, $2, $3, $4, $5)
+        ''', google_id, original, simplified, mode, url)
+        return True
+
+    async def get_user_history(self, google_id: str, limit: int = 50, offset: int = 0) -> list:
+        rows = await self.pool.fetch('''
+            SELECT original_text, simplified_text, mode, source_url,
+                   to_char(history.timestamp, 'YYYY-MM-DD HH24:MI:SS') AS timestamp
+            FROM history
+            WHERE google_id = $1
+            ORDER BY history.timestamp DESC
+            LIMIT $2 OFFSET $3
+        ''', google_id, limit, offset)
+        return [dict(row) for row in rows]
+
+    async def iter_user_history(self, google_id: str, chunk_size: int = EXPORT_CHUNK_SIZE):
+        async with self.pool.acquire() as conn:
+            # Server-side cursors only live inside a transaction
+            async with conn.transaction():
+                cursor = await conn.cursor('''
+                    SELECT original_text, simplified_text, mode, source_url,
+                           to_char(history.timestamp, 'YYYY-MM-DD HH24:MI:SS') AS timestamp
+                    FROM history
+                    WHERE google_id = $1
+                    ORDER BY history.timestamp
+                ''', google_id)
+                while True:
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        break
+                    yield [dict(row) for row in rows]
+
+    async def add_history_items(self, google_id: str, items: list) -> int:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany('''
+                    INSERT INTO history (google_id, original_text, simplified_text, mode, source_url, timestamp)
+                    VALUES ($1, $2, $3, $4, $5, COALESCE($6, CURRENT_TIMESTAMP))
+                ''', [
+                    (google_id, item['original_text'], item['simplified_text'], item['mode'],
+                     item.get('source_url'),
+                     datetime.strptime(item['timestamp'], '%Y-%m-%d %H:%M:%S') if item.get('timestamp') else None)
+                    for item in items
+                ])
+        return len(items)
+
+    async def record_usage(self, plan_id: str, mode: str, input_chars: int, output_chars: int) -> bool:
+        await self.pool.execute('''
+            INSERT INTO usage_daily (day, plan_id, mode, requests, input_chars, output_chars)
+            VALUES ($1, $2, $3, 1, $4, $5)
+            ON CONFLICT (day, plan_id, mode) DO UPDATE SET
+                requests = usage_daily.requests + 1,
+                input_chars = usage_daily.input_chars + excluded.input_chars,
+                output_chars = usage_daily.output_chars + excluded.output_chars
+        ''', datetime.now().date(), plan_id or 'free', mode, input_chars, output_chars)
+        return True
+
+    async def expire_subscriptions(self, today: date) -> int:
+        result = await self.pool.execute('''
+            UPDATE users SET subscription_id = 'free', subscription_expires = NULL
+            WHERE subscription_expires < $1 AND subscription_id != 'free'
+        ''', today)
+        return int(result.split()[-1])
+
+    async def reset_monthly_usage(self, today: date) -> int:
+        result = await self.pool.execute('''
+            UPDATE users SET requests_used = 0, last_reset = $1
+            WHERE last_reset < $2
+        ''', today, today.replace(day=1))
+        return int(result.split()[-1])
+
+    async def record_job_run(self, job: str, started_at: datetime, duration_ms: float, rows_affected: int) -> bool:
+        await self.pool.execute('''
+            INSERT INTO job_runs (job, started_at, duration_ms, rows_affected)
+            VALUES ($1, $2, $3, $4)
+        ''', job, started_at.replace(microsecond=0), duration_ms, rows_affected)
+        return True
+
+    async def get_job_runs(self, limit: int = 50) -> list:
+        rows = await self.pool.fetch('''
+            SELECT job, to_char(started_at, 'YYYY-MM-DD HH24:MI:SS') AS started_at,
+                   duration_ms, rows_affected
+            FROM job_runs
+            ORDER BY id DESC
+            LIMIT $1
+        ''', limit)
+        return [dict(row) for row in rows]
+
+def get_storage() -> Storage:
+    """Pick the backend from DATABASE_URL: PostgreSQL if set, otherwise local SQLite"""
+    database_url = os.getenv("DATABASE_URL")
+    if database_url and database_url.startswith(("postgres://", "postgresql://")):
+        return PostgresStorage(database_url)
+    return SQLiteStorage()
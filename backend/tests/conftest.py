@@ -0,0 +1,73 @@
+import json
+import os
+
+# Must be set before main/auth read them at import time
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("ADMIN_API_KEY", "test-admin-key")
+
+import httpx
+import openai
+import pytest
+from fastapi.testclient import TestClient
+
+import database
+from semantic_cache import NearDuplicateCache
+from storage import SQLiteStorage
+
+ADMIN_HEADERS = {"X-Admin-Key": os.environ["ADMIN_API_KEY"]}
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    """Fresh users.db in a temp dir, schema created"""
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "users.db"))
+    database.init_db()
+    return database
+
+class FakeOpenAI:
+    """Serves chat completion streams from an httpx.MockTransport, so the real openai client is exercised"""
+
+    def __init__(self):
+        self.tokens = ["Hello", " world"]
+        self.calls = 0
+        self.last_request = None
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        # Only the last body is kept, so memory tests do not measure the fake
+        self.calls += 1
+        self.last_request = json.loads(request.content)
+        events = [
+            "data: " + json.dumps({
+                "id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 0, "model": "gpt-4o-mini",
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]
+            }) + "\n\n"
+            for token in self.tokens
+        ]
+        events.append("data: [DONE]\n\n")
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content="".join(events).encode())
+
+    def client(self) -> openai.OpenAI:
+        return openai.OpenAI(api_key="test-key", http_client=httpx.Client(transport=httpx.MockTransport(self.handler)))
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    import main
+
+    fake = FakeOpenAI()
+    monkeypatch.setattr(main, "client", fake.client())
+    return fake
+
+@pytest.fixture
+def client(sqlite_db, fake_openai, monkeypatch):
+    """API client on the SQLite backend; the bearer token is used as the Google user id"""
+    import main
+
+    monkeypatch.setattr(main, "storage", SQLiteStorage())
+    monkeypatch.setattr(main, "near_dup_cache", NearDuplicateCache(quality_sample_rate=0))
+    monkeypatch.setattr(main, "SCHEDULER_ENABLED", False)
+    monkeypatch.setattr(main, "verify_google_token",
+                        lambda token, extension_id=None: {"id": token, "email": f"{token}@example.com"})
+    with TestClient(main.app) as c:
+        yield c
+
+def auth(user_id: str) -> dict:
+    return {"Authorization": f"Bearer {user_id}"}
@@ -0,0 +1,104 @@
+import csv
+import io
+import sqlite3
+
+import pyarrow.parquet as pq
+
+import main
+from conftest import ADMIN_HEADERS, auth
+from exporters import csv_chunks, parquet_chunks
+
+def test_record_usage_upserts_one_row_per_day_plan_mode(sqlite_db):
+    sqlite_db.record_usage('go', 'simple', 100, 40)
+    sqlite_db.record_usage('go', 'simple', 50, 20)
+    sqlite_db.record_usage('go', 'short', 10, 5)
+    sqlite_db.record_usage(None, 'simple', 1, 1)
+
+    with sqlite_db.get_db() as conn:
+        rows = conn.execute('SELECT plan_id, mode, requests, input_chars, output_chars FROM usage_daily ORDER BY plan_id, mode').fetchall()
+    assert [tuple(r) for r in rows] == [
+        ('free', 'simple', 1, 1, 1),
+        ('go', 'short', 1, 10, 5),
+        ('go', 'simple', 2, 150, 60),
+    ]
+
+def test_rollup_aggregates(sqlite_db):
+    sqlite_db.record_usage('go', 'simple', 100, 40)
+    sqlite_db.record_usage('go', 'simple', 50, 20)
+    sqlite_db.record_usage('go', 'short', 10, 6)
+
+    daily = sqlite_db.get_daily_usage()
+    assert len(daily) == 1
+    assert daily[0]['plan_id'] == 'go' and daily[0]['requests'] == 3 and daily[0]['output_chars'] == 66
+
+    modes = {m['mode']: m for m in sqlite_db.get_mode_usage()}
+    assert modes['simple']['avg_output_chars'] == 30.0
+    assert modes['short']['avg_input_chars'] == 10.0
+
+    assert sqlite_db.get_daily_usage(start='2000-01-01', end='2000-12-31') == []
+
+def test_csv_chunks_one_chunk_per_batch():
+    columns = [('id', 'INTEGER'), ('text', 'TEXT')]
+    batches = [[(1, 'a,b'), (2, 'line\nbreak')], [(3, None)]]
+
+    chunks = list(csv_chunks(columns, iter(batches)))
+    assert len(chunks) == 3  # header + one per batch
+    rows = list(csv.reader(io.StringIO("".join(chunks))))
+    assert rows == [['id', 'text'], ['1', 'a,b'], ['2', 'line\nbreak'], ['3', '']]
+
+def test_parquet_chunks_one_row_group_per_batch():
+    columns = [('id', 'INTEGER'), ('score', 'REAL'), ('text', 'TEXT')]
+    # sqlite may hand back a number from a TEXT column
+    batches = [[(1, 0.5, 'a'), (2, None, 7)], [(3, 1.5, None)]]
+
+    chunks = list(parquet_chunks(columns, iter(batches)))
+    assert len(chunks) >= 3  # data after each row group, then the footer
+    table = pq.read_table(io.BytesIO(b"".join(chunks)))
+    assert pq.ParquetFile(io.BytesIO(b"".join(chunks))).num_row_groups == 2
+    assert table.to_pylist() == [
+        {'id': 1, 'score': 0.5, 'text': 'a'},
+        {'id': 2, 'score': None, 'text': '7'},
+        {'id': 3, 'score': 1.5, 'text': None},
+    ]
+
+def test_admin_endpoints_require_key(client):
+    assert client.get('/admin/stats/daily').status_code == 403
+    assert client.get('/admin/stats/daily', headers={'X-Admin-Key': 'wrong'}).status_code == 403
+    assert client.get('/admin/stats/daily', headers=ADMIN_HEADERS).json() == []
+    assert client.get('/admin/stats/plans', headers=ADMIN_HEADERS).status_code == 200
+
+def test_admin_export_streams_in_chunks(client, sqlite_db):
+    for i in range(5):
+        sqlite_db.record_usage('go', f'mode{i}', i, i)
+    assert [len(b) for b in sqlite_db.iter_table_rows('usage_daily', chunk_size=2)] == [2, 2, 1]
+
+    r = client.get('/admin/export/usage_daily', headers=ADMIN_HEADERS)
+    assert r.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(r.text)))
+    assert sorted(row['mode'] for row in rows) == [f'mode{i}' for i in range(5)]
+
+    r = client.get('/admin/export/usage_daily?format=parquet', headers=ADMIN_HEADERS)
+    assert pq.read_table(io.BytesIO(r.content)).num_rows == 5
+
+    assert client.get('/admin/export/sqlite_master', headers=ADMIN_HEADERS).status_code == 404
+    assert client.get('/admin/export/users?format=xml', headers=ADMIN_HEADERS).status_code == 400
+
+def test_rollup_failure_does_not_reach_the_user(client, monkeypatch):
+    def fail(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    async def fail_async(*args, **kwargs):
+        fail()
+
+    monkeypatch.setattr(main.storage, "record_usage", fail_async)
+    monkeypatch.setattr(main.near_dup_cache, "store", fail)
+    r = client.post('/simplify', headers=auth('u1'), json={'text': 'Some text', 'mode': 'simple', 'language': 'en'})
+    assert r.text == 'Hello world'
+
+def test_failure_before_output_reports_system_error(client, monkeypatch):
+    def fail(text):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(main, "fingerprint_text", fail)
+    r = client.post('/simplify', headers=auth('u1'), json={'text': 'Some text', 'mode': 'simple', 'language': 'en'})
+    assert r.text == main.get_error_message('system_error', 'en')
@@ -0,0 +1,106 @@
+import asyncio
+import gzip
+import json
+import time
+
+import pytest
+
+import database
+import main
+from conftest import auth
+from storage import SQLiteStorage
+
+def entry(i: int, **overrides) -> dict:
+    item = {'original_text': f'original {i}', 'simplified_text': f'simple {i}', 'mode': 'simple',
+            'source_url': None, 'timestamp': f'2024-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}'}
+    item.update(overrides)
+    return item
+
+def ndjson(items) -> bytes:
+    return "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in items).encode()
+
+@pytest.fixture
+def history_user(client):
+    client.post('/upgrade', headers=auth('u1'), json={'plan_id': 'go_plus'})
+    return 'u1'
+
+def test_export_import_round_trip(client, history_user, monkeypatch):
+    monkeypatch.setattr(main, 'HISTORY_IMPORT_BATCH_SIZE', 100)
+    items = [entry(i, original_text=f'текст {i}, "quoted"\nline') for i in range(250)]
+
+    r = client.post('/history/import', headers=auth(history_user), content=ndjson(items))
+    assert r.json() == {'status': 'success', 'imported': 250}
+
+    r = client.get('/history/export', headers=auth(history_user))
+    assert r.headers['content-type'] == 'application/x-ndjson'
+    assert [json.loads(line) for line in r.text.splitlines()] == items
+
+    r = client.get('/history/export?format=gzip', headers=auth(history_user))
+    exported = gzip.decompress(r.content)
+    assert [json.loads(line) for line in exported.splitlines()] == items
+
+    # A gzip export imports straight back
+    client.post('/upgrade', headers=auth('u2'), json={'plan_id': 'go_plus'})
+    r = client.post('/history/import', headers={**auth('u2'), 'Content-Encoding': 'gzip'}, content=r.content)
+    assert r.json()['imported'] == 250
+
+def test_history_requires_plan(client):
+    assert client.get('/history/export', headers=auth('free_user')).status_code == 403
+    assert client.post('/history/import', headers=auth('free_user'), content=ndjson([entry(0)])).status_code == 403
+
+def test_import_converts_offsets_to_utc(client, history_user):
+    items = [entry(0, timestamp='2024-01-01T00:00:00+03:00'), entry(1, timestamp='2024-01-01T12:00:00Z'),
+             entry(2, timestamp='2024-01-01T05:00:00')]
+    client.post('/history/import', headers=auth(history_user), content=ndjson(items))
+    stamps = sorted(h['timestamp'] for h in client.get('/history', headers=auth(history_user)).json())
+    assert stamps == ['2023-12-31 21:00:00', '2024-01-01 05:00:00', '2024-01-01 12:00:00']
+
+@pytest.mark.parametrize('bad', [
+    {'source_url': {'nested': 1}},
+    {'source_url': 5},
+    {'timestamp': 'yesterday'},
+    {'mode': None, 'original_text': None},
+])
+def test_import_rejects_invalid_entries(client, history_user, bad):
+    body = ndjson([entry(0), {**entry(1), **bad}])
+    r = client.post('/history/import', headers=auth(history_user), content=body)
+    assert r.status_code == 400
+    assert r.json()['detail'] == 'Invalid history entry on line 2'
+
+def test_import_rejects_long_line(client, history_user, monkeypatch):
+    monkeypatch.setattr(main, 'HISTORY_IMPORT_MAX_LINE_BYTES', 1000)
+    r = client.post('/history/import', headers=auth(history_user), content=b'{' + b' ' * 5000)
+    assert r.status_code == 413
+
+def test_import_caps_gzip_bomb(client, history_user, monkeypatch):
+    monkeypatch.setattr(main, 'HISTORY_IMPORT_MAX_BYTES', 10 * 1024 * 1024)
+    monkeypatch.setattr(main, 'HISTORY_IMPORT_MAX_LINE_BYTES', 20 * 1024 * 1024)
+    bomb = gzip.compress(b'\n' * (64 * 1024 * 1024))
+    assert len(bomb) < 100_000
+    r = client.post('/history/import', headers={**auth(history_user), 'Content-Encoding': 'gzip'}, content=bomb)
+    assert r.status_code == 413
+
+def test_iter_user_history_closes_after_cancelled_fetch(monkeypatch):
+    closed = []
+
+    def slow_history(google_id, chunk_size):
+        try:
+            time.sleep(0.3)
+            yield [{'n': 1}]
+            yield [{'n': 2}]
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(database, 'iter_user_history', slow_history)
+
+    async def scenario():
+        batches = SQLiteStorage().iter_user_history('u1')
+        fetch = asyncio.ensure_future(batches.__anext__())
+        await asyncio.sleep(0.05)  # the worker thread is now inside next()
+        fetch.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await fetch
+        await batches.aclose()
+
+    asyncio.run(scenario())
+    assert closed == [True]
@@ -0,0 +1,93 @@
+import asyncio
+import gc
+import json
+import time
+import tracemalloc
+
+import database
+import main
+
+STREAMS = 500
+INPUT_CHARS = 100_000
+
+def add_users(count: int):
+    with database.get_db() as conn:
+        conn.executemany(
+            "INSERT INTO users (google_id, requests_used, last_reset, subscription_id) VALUES (?, 0, ?, 'go_pro_ultra')",
+            [(f"user{i}", time.strftime('%Y-%m-%d')) for i in range(count)]
+        )
+
+def simplify_body(i: int) -> bytes:
+    # Long "words" keep fingerprinting cheap; the input size is what matters here
+    text = f"{i} " + ("x" * 999 + " ") * (INPUT_CHARS // 1000 - 1)
+    return json.dumps({"text": text, "mode": "simple", "language": "en"}).encode()
+
+async def post_simplify(user_id: str, body: bytes) -> tuple:
+    """Drives the ASGI app directly, so no client-side objects outlive the request"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/simplify", "raw_path": b"/simplify", "query_string": b"", "root_path": "",
+        "headers": [(b"authorization", f"Bearer {user_id}".encode()), (b"content-type", b"application/json")],
+        "client": ("test", 0), "server": ("test", 80)
+    }
+    pending = [body]
+    del body
+    status, length = None, 0
+
+    async def receive():
+        if pending:
+            return {"type": "http.request", "body": pending.pop(), "more_body": False}
+        await asyncio.Event().wait()  # no disconnect; cancelled once the response is done
+
+    async def send(message):
+        nonlocal status, length
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        else:
+            length += len(message.get("body", b""))
+
+    await main.app(scope, receive, send)
+    return status, length
+
+def run_streams(first_user: int, count: int) -> list:
+    async def scenario():
+        return await asyncio.gather(*(post_simplify(f"user{i}", simplify_body(i))
+                                      for i in range(first_user, first_user + count)))
+    return asyncio.run(scenario())
+
+def test_concurrent_long_streams_stay_flat(client, fake_openai):
+    # A runaway model stream: far more output than max_tokens allows
+    fake_openai.tokens = ["abcdefghij" * 64] * 20
+    add_users(2 * STREAMS + 10)
+    run_streams(2 * STREAMS, 10)  # warm up lazy imports outside the measurement
+
+    gc.collect()
+    gc.disable()  # request memory must be released by refcounting, not by a later GC pass
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        first = run_streams(0, STREAMS)
+        first_retained, first_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        second = run_streams(STREAMS, STREAMS)
+        second_retained, second_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        gc.enable()
+
+    assert all(status == 200 and length == main.MAX_RESPONSE_CHARS for status, length in first + second)
+
+    # All in-flight inputs are alive at once, but each is held in no more than a few copies
+    assert first_peak - baseline < STREAMS * 5 * INPUT_CHARS
+    # and nothing per request outlives it, so a second wave peaks no higher than the first
+    assert first_retained - baseline < STREAMS * INPUT_CHARS // 20
+    assert second_retained - baseline < STREAMS * INPUT_CHARS // 20
+    assert second_peak < first_peak * 1.1
+
+def test_input_cap_applies_to_every_plan(client, monkeypatch):
+    monkeypatch.setattr(main, "MAX_INPUT_CHARS", 1000)
+    add_users(1)
+    r = client.post("/simplify", headers={"Authorization": "Bearer user0"},
+                    json={"text": "x" * 1001, "mode": "simple", "language": "en"})
+    assert r.status_code == 400
+    assert r.json()["detail"] == "Text too long for your plan (max 1000 chars)"
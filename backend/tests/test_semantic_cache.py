@@ -0,0 +1,153 @@
+import random
+import time
+
+import main
+from conftest import auth
+from semantic_cache import (
+    BAND_BITS, BANDS, MIN_FUZZY_TOKENS, Fingerprint, NearDuplicateCache,
+    context_key, fingerprint_text, jaccard, similarity, token_sketch, tokenize
+)
+
+SETTINGS = {'simple_level': 5, 'short_level': 5, 'points_count': 5, 'examples_count': 2}
+
+def words(n: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    return ["".join(rng.choice("abcdefghij") for _ in range(6)) for _ in range(n)]
+
+def flipped(fp: Fingerprint, bits: list) -> Fingerprint:
+    """Same tokens but a different SimHash and digest"""
+    simhash = fp.simhash
+    for bit in bits:
+        simhash ^= 1 << bit
+    return fp._replace(simhash=simhash, digest=b'other-digest')
+
+def test_tokenize_normalizes_case_whitespace_and_citations():
+    assert tokenize("  The  Cell[12] is\nsmall [ 3 ], right?[citation needed]") == ['the', 'cell', 'is', 'small', 'right']
+    a = fingerprint_text("Hello,   World [1]\n")
+    b = fingerprint_text("hello world")
+    assert a.digest == b.digest and a.simhash == b.simhash
+
+def test_bands_partition_the_fingerprint():
+    cache = NearDuplicateCache()
+    fp = fingerprint_text(" ".join(words(50)))
+    bands = list(cache._bands(fp.simhash))
+    assert len(bands) == BANDS
+    assert sum(value << (band * BAND_BITS) for band, value in bands) == fp.simhash
+
+def test_banding_finds_any_pair_within_seven_bits():
+    cache = NearDuplicateCache()
+    ctx = context_key('short', 'en', SETTINGS, 'u1')
+    fp = fingerprint_text(" ".join(words(100)))
+    cache.store(ctx, fp, 'cached')
+    # One flipped bit in each of 6 bands: only two bands still match, and similarity is 58/64
+    probe = flipped(fp, [0, 8, 16, 24, 32, 40])
+    assert similarity(fp.simhash, probe.simhash) >= 0.9
+    assert cache.lookup(ctx, probe) == 'cached'
+
+def test_thresholds_are_per_mode():
+    cache = NearDuplicateCache()
+    fp = fingerprint_text(" ".join(words(100)))
+    for mode in ['simple', 'short']:
+        cache.store(context_key(mode, 'en', SETTINGS, 'u1'), fp, mode)
+
+    four_bits = flipped(fp, [1, 2, 3, 4])  # similarity 0.9375
+    assert cache.lookup(context_key('simple', 'en', SETTINGS, 'u1'), four_bits) is None  # needs 0.94
+    assert cache.lookup(context_key('short', 'en', SETTINGS, 'u1'), four_bits) == 'short'  # needs 0.9
+    assert cache.lookup(context_key('simple', 'en', SETTINGS, 'u1'), flipped(fp, [1, 2, 3])) == 'simple'
+
+def test_short_texts_only_match_exactly():
+    cache = NearDuplicateCache()
+    ctx = context_key('simple', 'en', SETTINGS, 'u1')
+    fp = fingerprint_text(" ".join(words(MIN_FUZZY_TOKENS - 1)))
+    cache.store(ctx, fp, 'cached')
+    assert cache.lookup(ctx, flipped(fp, [])) is None
+    assert cache.lookup(ctx, fp) == 'cached'
+
+def test_sketch_jaccard_is_exact_for_small_sets_and_bounded_for_large():
+    assert jaccard(token_sketch(['a', 'b', 'c']), token_sketch(['b', 'c', 'd'])) == 0.5
+    big = words(20000)
+    sketch = token_sketch(big)
+    assert len(sketch) == 256
+    assert jaccard(sketch, token_sketch(big[:19000])) > 0.85
+    assert jaccard(sketch, token_sketch(words(20000, seed=1))) < 0.1
+
+def test_negation_is_never_reused():
+    cache = NearDuplicateCache()
+    ctx = context_key('simple', 'en', SETTINGS, 'u1')
+    body = words(600)
+    safe = fingerprint_text(" ".join(body[:300] + ['is', 'safe'] + body[300:]))
+    unsafe = fingerprint_text(" ".join(body[:300] + ['is', 'not', 'safe'] + body[300:]))
+    assert similarity(safe.simhash, unsafe.simhash) >= 0.94  # SimHash alone cannot tell them apart
+
+    cache.store(ctx, safe, 'it is safe')
+    assert cache.lookup(ctx, unsafe) is None
+    assert cache.get_stats()['rejected_by_verifier'] == 1
+
+def test_same_simhash_different_text_is_not_an_exact_hit():
+    cache = NearDuplicateCache()
+    ctx = context_key('simple', 'en', SETTINGS, 'u1')
+    fp = fingerprint_text(" ".join(words(100)))
+    cache.store(ctx, fp, 'cached')
+    # Identical SimHash, but the token sets disagree beyond the Jaccard bound
+    impostor = fp._replace(digest=b'different', sketch=token_sketch(words(100, seed=1)))
+    assert cache.lookup(ctx, impostor) is None
+    assert cache.get_stats()['exact_hits'] == 0
+
+def test_entries_are_scoped_per_user_by_default():
+    cache = NearDuplicateCache()
+    fp = fingerprint_text(" ".join(words(100)))
+    cache.store(context_key('simple', 'en', SETTINGS, 'u1', 'go'), fp, 'cached')
+    assert cache.lookup(context_key('simple', 'en', SETTINGS, 'u2', 'go'), fp) is None
+    assert cache.lookup(context_key('simple', 'ru', SETTINGS, 'u1', 'go'), fp) is None
+    assert cache.lookup(context_key('simple', 'en', SETTINGS, 'u1', 'go'), fp) == 'cached'
+
+def test_lru_eviction_cleans_the_index():
+    cache = NearDuplicateCache(max_entries=2)
+    ctx = context_key('simple', 'en', SETTINGS, 'u1')
+    a, b, c = (fingerprint_text(" ".join(words(100, seed=i))) for i in range(3))
+    cache.store(ctx, a, 'a')
+    cache.store(ctx, b, 'b')
+    assert cache.lookup(ctx, a) == 'a'  # a is now most recently used
+    cache.store(ctx, c, 'c')
+
+    assert cache.lookup(ctx, b) is None
+    assert cache.lookup(ctx, a) == 'a' and cache.lookup(ctx, c) == 'c'
+    assert len(cache.entries) == 2 and len(cache.exact) == 2
+    live = set(cache.entries)
+    assert all(ids and ids <= live for ids in cache.buckets.values())
+    assert cache.get_stats()['evictions'] == 1
+
+def test_cache_is_bounded_by_total_chars():
+    cache = NearDuplicateCache(max_chars=10)
+    ctx = context_key('simple', 'en', SETTINGS, 'u1')
+    a, b, c = (fingerprint_text(" ".join(words(100, seed=i))) for i in range(3))
+    cache.store(ctx, a, 'x' * 6)
+    cache.store(ctx, b, 'y' * 6)
+    cache.store(ctx, c, 'z' * 11)  # larger than the whole budget, never stored
+    assert cache.lookup(ctx, a) is None and cache.lookup(ctx, b) == 'y' * 6 and cache.lookup(ctx, c) is None
+    assert cache.get_stats()['chars'] == 6
+
+def test_quality_stats():
+    cache = NearDuplicateCache()
+    assert cache.record_quality('The cell is small.', 'the cell is small') == 1.0
+    assert cache.record_quality('one two three four', 'one two five six') == 0.5
+    stats = cache.get_stats()
+    assert stats['quality_samples'] == 2 and stats['quality_score_avg'] == 0.75 and stats['quality_score_min'] == 0.5
+
+def test_stream_reuses_and_samples_hits(client, fake_openai, monkeypatch):
+    client.post('/upgrade', headers=auth('u1'), json={'plan_id': 'go_plus'})
+    text = " ".join(words(40))
+
+    assert client.post('/simplify', headers=auth('u1'), json={'text': text, 'mode': 'simple'}).text == 'Hello world'
+    time.sleep(2.1)
+    assert client.post('/simplify', headers=auth('u1'), json={'text': text + ' [4]', 'mode': 'simple'}).text == 'Hello world'
+    assert fake_openai.calls == 1
+
+    # Sampled hits are regenerated and scored against the cached output
+    monkeypatch.setattr(main.near_dup_cache, 'quality_sample_rate', 1.0)
+    fake_openai.tokens = ["Hello", " there"]
+    time.sleep(2.1)
+    assert client.post('/simplify', headers=auth('u1'), json={'text': text, 'mode': 'simple'}).text == 'Hello there'
+    assert fake_openai.calls == 2
+    stats = main.near_dup_cache.get_stats()
+    assert stats['quality_samples'] == 1 and stats['quality_score_avg'] == 0.5